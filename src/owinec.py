@@ -17,61 +17,186 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import atexit
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import ssl
+import io
 import ipaddress
 import logging
+import logging.handlers
+import queue
+import re
+import os
+import socket
 from socketserver import ThreadingMixIn
+import contextvars
 import threading
+import uuid
+from xml.sax.saxutils import escape
 import wsman
-import xml.etree.ElementTree as ET
+
+try:
+    # lxml's C DOM builder parses large WS-Man envelopes several times faster
+    # than the pure-Python expat callbacks and accepts raw bytes directly.
+    # Parser objects are not usable concurrently (a shared one would serialize
+    # all handler threads on its internal lock), so each thread gets its own;
+    # lxml releases the GIL while parsing, letting the parses run in parallel
+    from lxml import etree as _etree
+    _xml_parsers = threading.local()
+
+    def parse_xml(payload: bytes) -> _etree.Element:
+        if not isinstance(payload, bytes):
+            # lxml only accepts str/bytes, not bytearray/memoryview
+            payload = bytes(payload)
+        parser = getattr(_xml_parsers, 'parser', None)
+        if parser is None:
+            parser = _xml_parsers.parser = _etree.XMLParser(huge_tree=True, recover=False)
+        return _etree.fromstring(payload, parser=parser)
+except ImportError:
+    import xml.etree.ElementTree as _etree
+
+    def parse_xml(payload: bytes) -> _etree.Element:
+        return _etree.fromstring(payload)
 
 WSMAN_PORT_HTTP = 5985
 WSMAN_PORT_HTTPS = 5986
 
+# hard ceiling for request payloads, matching the MaxEnvelopeSize advertised
+# in the subscription; anything larger is rejected before being read
+MAX_ENVELOPE_SIZE = 10 * 1024 * 1024
+
+# what WEC clients send on virtually every request; checked first so the
+# charset regex only runs for the unusual cases (quoted or UTF-16 charsets)
+CONTENT_TYPE_SOAP_UTF8 = 'application/soap+xml;charset=UTF-8'
+
+PATTERN_CHARSET = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+
+PATTERN_SENTINEL = re.compile('__(?:MESSAGE_ID|OPERATION_ID|RELATES_TO|TO)__')
+
+# per-thread scratch buffer for request bodies; connections are pinned to
+# their handler thread, so the buffer is reused across Keep-Alive requests
+# instead of allocating a fresh payload per POST
+_scratch = threading.local()
+
+# peer address of the connection being handled, exposed to log formats as
+# %(peer)s; a contextvar avoids renaming the handler thread (and taking the
+# thread registry lock) on every request
+_peer = contextvars.ContextVar('peer', default='-')
+
+_log_record_factory = logging.getLogRecordFactory()
+
+
+def _record_factory(*args, **kwargs):
+    record = _log_record_factory(*args, **kwargs)
+    record.peer = _peer.get()
+    return record
+
+
+logging.setLogRecordFactory(_record_factory)
+
+# response head for the common 200 OK case, sent in a single write together
+# with the body instead of one small write per header line
+OK_RESPONSE_HEAD = (b'%b 200 OK\r\n'
+                    b'Server: %b\r\n'
+                    b'Date: %b\r\n'
+                    b'WWW-Authenticate: http://schemas.dmtf.org/wbem/wsman/1/wsman/secprofile/https/mutual\r\n'
+                    b'Content-Type: application/soap+xml;charset=UTF-8\r\n'
+                    b'Content-Length: %d\r\n'
+                    b'Connection: Keep-Alive\r\n'
+                    b'\r\n')
+
 ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
 # ctx = ssl.create_default_context()
 ctx.check_hostname = False
 ctx.load_cert_chain('/root/server-cert.pem', '/root/server-key.pem')
+# WEC clients reconnect on every heartbeat interval and after network blips;
+# session resumption lets them skip the full asymmetric handshake on
+# reconnect. OpenSSL's server-side session cache is on by default for server
+# contexts, TLS 1.3 clients resume via tickets instead.
+ctx.num_tickets = 2
+ctx.options |= ssl.OP_NO_RENEGOTIATION | ssl.OP_NO_COMPRESSION | ssl.OP_SINGLE_ECDH_USE
+ctx.sni_callback = None
 
 
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 def setup_logger(name, log_file, level=logging.INFO):
     """To setup as many loggers as you want"""
 
-    handler = logging.FileHandler(log_file)        
+    handler = logging.FileHandler(log_file)
     handler.setFormatter(formatter)
 
+    # request threads only enqueue records; a single listener thread does the
+    # blocking file writes, so concurrent POSTs do not serialize on disk I/O
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+
+    def stop_listener():
+        # flush queued records to disk on orderly exit; idempotent so the
+        # forked workers can register it again after restarting the listener
+        if listener._thread is not None:
+            listener.stop()
+    atexit.register(stop_listener)
+
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    logger.addHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
-    return logger
+    return logger, listener
+
+event_logger, event_log_listener = setup_logger("event-logger", "event.log")
+
+
+class WSManServer(ThreadingHTTPServer):
+    # one thread per persistent Keep-Alive subscriber: don't track/join them
+    # on shutdown and allow a deeper accept backlog for reconnect storms
+    daemon_threads = True
+    block_on_close = False
+    request_queue_size = 128
+
+    def server_bind(self):
+        if hasattr(socket, 'SO_REUSEPORT'):
+            # lets additional worker processes bind the same port and have
+            # the kernel load-balance the accept queues
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
 
-event_logger = setup_logger("event-logger", "event.log")
 
 class SoapHandler(BaseHTTPRequestHandler):
     server_version = 'owinec/1.0'
+    # acks are small; don't let Nagle hold them back until the next segment
+    disable_nagle_algorithm = True
+
+    # (action, resource uri) -> handler method name, resolved via getattr so
+    # subclasses can override the handlers; one hashed lookup per request
+    # instead of a chain of URI comparisons
+    DISPATCH = {
+        (wsman.ACTION_END, wsman.RESOURCE_URI_FULL_DUPLEX): 'do_end',
+        (wsman.ACTION_ENUMERATE, wsman.RESOURCE_URI_SUBSCRIPTION): 'do_enumerate',
+        (wsman.ACTION_HEARTBEAT, None): 'do_heartbeat',
+        (wsman.ACTION_END_SUBSCRIPTION, None): 'do_end_subscription',
+        (wsman.ACTION_EVENTS, None): 'do_events',
+    }
 
     def parse_request(self):
-        threading.current_thread().setName(f'{self.client_address[0]}:{self.client_address[1]}')
+        _peer.set(f'{self.client_address[0]}:{self.client_address[1]}')
         return super().parse_request()
 
     def do_GET(self):
-        logger.info(f'GET {self.path} from {self.address_string()}, invalid method')
+        logger.info('GET %s from %s, invalid method', self.path, self.address_string())
         self.send_response(HTTPStatus(HTTPStatus.METHOD_NOT_ALLOWED))
         self.end_headers()
         self.wfile.write(b'Method Not Allowed')
 
     def do_PUT(self):
-        logger.info(f'PUT {self.path} from {self.address_string()}, invalid method')
+        logger.info('PUT %s from %s, invalid method', self.path, self.address_string())
         self.send_response(HTTPStatus(HTTPStatus.METHOD_NOT_ALLOWED))
         self.end_headers()
         self.wfile.write(b'Method Not Allowed')
 
     def do_POST(self):
-        logger.info(f'POST {self.path} from {self.address_string()}')
+        logger.info('POST %s from %s', self.path, self.address_string())
 
         if isinstance(self.connection, ssl.SSLSocket):
             # Certificate Authentication
@@ -80,7 +205,7 @@ class SoapHandler(BaseHTTPRequestHandler):
         else:
             # Other Authentication Protocols are not supported
             auth = self.headers['Authorization'] if 'Authorization' in self.headers else None
-            logger.warning(f'401 Unauthorized - Unsupported authentication protocol: {auth}')
+            logger.warning('401 Unauthorized - Unsupported authentication protocol: %s', auth)
             self.send_response(HTTPStatus(HTTPStatus.UNAUTHORIZED))
             self.send_header('WWW-Authenticate', 'http://schemas.dmtf.org/wbem/wsman/1/wsman/secprofile/https/mutual')
             self.end_headers()
@@ -88,13 +213,15 @@ class SoapHandler(BaseHTTPRequestHandler):
             return
 
         content_length = int(self.headers['Content-Length']) if 'Content-Length' in self.headers else 0
-        content_type = (self.headers['Content-Type'] or '').split(';')
-        charset = None
-        if len(content_type) > 1 and content_type[1].strip().startswith('charset='):
-            charset = content_type[1].strip()[8:]
+        content_type = self.headers['Content-Type'] or ''
+        if content_type == CONTENT_TYPE_SOAP_UTF8:
+            charset = 'UTF-8'
+        else:
+            match = PATTERN_CHARSET.search(content_type)
+            charset = match.group(1) if match else None
 
         if content_length == 0:
-            logger.warning(f'{self.path} - {HTTPStatus.LENGTH_REQUIRED} Length Required')
+            logger.warning('%s - %s Length Required', self.path, HTTPStatus.LENGTH_REQUIRED)
             self.send_response(HTTPStatus(HTTPStatus.LENGTH_REQUIRED))
             self.send_header('WWW-Authenticate', 'http://schemas.dmtf.org/wbem/wsman/1/wsman/secprofile/https/mutual')
             self.send_header('Content-Length', '0')
@@ -103,53 +230,75 @@ class SoapHandler(BaseHTTPRequestHandler):
             self.wfile.write(b'Length Required - This request requires a payload')
             return
 
-        payload = self.rfile.read(content_length)
-        if charset == 'UTF-16':
-            text = payload.decode('utf16')
-        else:
-            text = payload.decode('utf8')
+        if content_length > MAX_ENVELOPE_SIZE:
+            logger.warning('%s - 413 Payload Too Large (%d bytes)', self.path, content_length)
+            self.send_response(HTTPStatus(HTTPStatus.REQUEST_ENTITY_TOO_LARGE))
+            self.send_header('Content-Length', '0')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'Payload Too Large - Envelopes are limited to 10 MiB')
+            return
 
-        logger.info(f"input data {text}")
+        buf = getattr(_scratch, 'buf', None)
+        if buf is None or len(buf) < content_length:
+            buf = bytearray(max(content_length, 64 * 1024))
+            _scratch.buf = buf
+        payload = memoryview(buf)[:content_length]
+        if self.rfile.readinto(payload) != content_length:
+            logger.warning('%s - connection closed before the payload was fully received', self.path)
+            self.close_connection = True
+            return
 
-        envelope = wsman.Envelope.load(ET.fromstring(text))
-        logger.debug(f'Action={envelope.action}, ResourceURI={envelope.resource_uri}')
-        for error in envelope.errors:
-            logger.error(f'From {error["machine"]} (code {error["code"]}): {error["text"]}')
-            if error['code'] == 5004 or error['code'] == 1818:
-                logger.error(f'Tip: Verify that \'NT Authority\\Network Service\' is a member of the '
-                             f'\'Event Log Readers\' group on the source computer.')
-
-        response = None
-        if envelope.action == wsman.ACTION_END and envelope.resource_uri == wsman.RESOURCE_URI_FULL_DUPLEX:
-            response = ''
-        elif envelope.action == wsman.ACTION_ENUMERATE and envelope.resource_uri == wsman.RESOURCE_URI_SUBSCRIPTION:
-            # Initial request from client
-            response = self.do_enumerate(envelope)
-        elif envelope.action == wsman.ACTION_HEARTBEAT and envelope.resource_uri is None:
-            response = self.do_heartbeat(envelope)
-        elif envelope.action == wsman.ACTION_END_SUBSCRIPTION and envelope.resource_uri is None:
-            response = ''
-        elif envelope.action == wsman.ACTION_EVENTS and envelope.resource_uri is None:
-            response = self.do_events(envelope)
-        else:
-            logger.info(f'{self.path} - {envelope.action}/{envelope.resource_uri} - 501 Not implemented')
-            logger.warning(f'Envelope not implemented: {text}')
+        # the XML parser consumes the raw bytes directly (the encoding is
+        # taken from the BOM/XML declaration); only decode a copy of the
+        # payload when it is actually going to be logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('input data %s', payload.tobytes().decode('utf16' if charset == 'UTF-16' else 'utf8'))
+
+        envelope = None
+        if charset != 'UTF-16' and buf.find(wsman.ACTION_EVENTS.encode('utf8'), 0, content_length) >= 0:
+            # Events envelopes can reach max_envelope_size; stream-parse them
+            # instead of building a DOM of the whole body. The URI match can
+            # be a false positive, in which case stream() returns None
+            envelope = wsman.EventsEnvelope.stream(io.BytesIO(payload))
+        if envelope is None:
+            envelope = wsman.Envelope.load(parse_xml(payload))
+        logger.debug('Action=%s, ResourceURI=%s', envelope.action, envelope.resource_uri)
+
+        action = envelope.action.id if envelope.action else None
+        resource_uri = envelope.resource_uri.id if envelope.resource_uri else None
+        handler = self.DISPATCH.get((action, resource_uri))
+        if handler is None:
+            self.log_errors(envelope)
+            logger.info('%s - %s/%s - 501 Not implemented', self.path, envelope.action, envelope.resource_uri)
+            logger.warning('Envelope not implemented: %s',
+                           payload.tobytes().decode('utf16' if charset == 'UTF-16' else 'utf8'))
             self.send_response(HTTPStatus(HTTPStatus.NOT_IMPLEMENTED))
             self.send_header('WWW-Authenticate', 'http://schemas.dmtf.org/wbem/wsman/1/wsman/secprofile/https/mutual')
             self.end_headers()
             self.wfile.write(b'Not Implemented')
             return
+        response = getattr(self, handler)(envelope)
+        # only after the handler ran: the streaming events path discovers
+        # faults while the event generator is being consumed
+        self.log_errors(envelope)
 
-        logger.info(f"output data: {response}")
+        logger.debug('output data: %s', response)
         response = response.encode('utf8')
-        logger.info(f'{self.path} - {envelope.action}/{envelope.resource_uri}')
-        self.send_response(HTTPStatus(HTTPStatus.OK))
-        self.send_header('WWW-Authenticate', 'http://schemas.dmtf.org/wbem/wsman/1/wsman/secprofile/https/mutual')
-        self.send_header('Content-Type', 'application/soap+xml;charset=UTF-8')
-        self.send_header('Content-Length', str(len(response)))
-        self.send_header('Connection', 'Keep-Alive')
-        self.end_headers()
-        self.wfile.write(response)
+        logger.info('%s - %s/%s', self.path, envelope.action, envelope.resource_uri)
+        head = OK_RESPONSE_HEAD % (self.protocol_version.encode('latin1'),
+                                   self.version_string().encode('latin1'),
+                                   self.date_time_string().encode('latin1'),
+                                   len(response))
+        self.close_connection = False
+        self.wfile.write(head + response)
+
+    def log_errors(self, envelope: wsman.Envelope):
+        for error in envelope.errors:
+            logger.error('From %s (code %s): %s', error['machine'], error['code'], error['text'])
+            if error['code'] == 5004 or error['code'] == 1818:
+                logger.error('Tip: Verify that \'NT Authority\\Network Service\' is a member of the '
+                             '\'Event Log Readers\' group on the source computer.')
 
     def send_response(self, code: HTTPStatus, message=None):
         return super().send_response(code, message=message)
@@ -157,46 +306,72 @@ class SoapHandler(BaseHTTPRequestHandler):
     def log_message(self, format, *args):
         return
 
+    def do_end(self, envelope: wsman.Envelope) -> str:
+        return ''
+
     def do_enumerate(self, envelope: wsman.EnumerateSubscriptionEnvelope) -> str:
         pass
 
     def do_heartbeat(self, envelope: wsman.HeartbeatEnvelope) -> str:
         pass
 
+    def do_end_subscription(self, envelope: wsman.Envelope) -> str:
+        return ''
+
     def do_events(self, envelope: wsman.EventsEnvelope) -> str:
         pass
 
 
+def _build_enumerate_response_template() -> str:
+    """Serialize the (static) enumerate response once, with sentinels for the
+    fields that differ between requests."""
+    subscription = wsman.SubscriptionEnvelope(
+        'subscription2', 'Test Subscription 2', 'https://10.0.1.170:5986/owinec/subscriptions/s2',
+        [('Security', '*[System[(Level=1 or Level=2 or Level=3 or Level=4 or Level=0 or Level=5)]]'),
+         ('System', '*[System[(Level=1 or Level=2 or Level=3 or Level=4 or Level=0 or Level=5)]]')],
+        ['663FC825E1657B6361DB624E549EF8EA839684A0'] # Replace by CA thumbprint
+    )
+    subscription.bookmarks = False
+    subscription.read_existing_events = True
+    subscription.content_format = 'RenderedText'
+    subscription.max_time = 0.0
+    subscription.connection_retries = 60
+    subscription.connection_retries_wait = 10.0
+    subscription.heartbeat_sec = 60.0
+    subscription.max_envelope_size = MAX_ENVELOPE_SIZE
+    response = wsman.EnumerateResponseEnvelope(subscription, '__OPERATION_ID__',
+                                               relates_to='__RELATES_TO__', message_id='__MESSAGE_ID__')
+    response.to = '__TO__'
+    return response.dump()
+
+
 class WSManHandler(SoapHandler):
+    ENUMERATE_RESPONSE_TEMPLATE = _build_enumerate_response_template()
+
     def do_enumerate(self, envelope: wsman.EnumerateSubscriptionEnvelope) -> str:
-        subscription = wsman.SubscriptionEnvelope(
-            'subscription2', 'Test Subscription 2', 'https://10.0.1.170:5986/owinec/subscriptions/s2',
-            [('Security', '*[System[(Level=1 or Level=2 or Level=3 or Level=4 or Level=0 or Level=5)]]'),
-             ('System', '*[System[(Level=1 or Level=2 or Level=3 or Level=4 or Level=0 or Level=5)]]')],
-            ['663FC825E1657B6361DB624E549EF8EA839684A0'] # Replace by CA thumbprint
-        )
-        subscription.bookmarks = False
-        subscription.read_existing_events = True
-        subscription.content_format = 'RenderedText'
-        subscription.max_time = 0.0
-        subscription.connection_retries = 60
-        subscription.connection_retries_wait = 10.0
-        subscription.heartbeat_sec = 60.0
-        subscription.max_envelope_size = 10 * 1024 * 1024
-        response = wsman.EnumerateResponseEnvelope(subscription, envelope.operation_id, relates_to=envelope.id)
-        response.to = envelope.reply_to
-        return response.dump()
+        # the subscription config is fixed, so only the addressing fields have
+        # to be substituted; no ElementTree build/serialize cycle per request.
+        # The client-controlled values are XML-escaped and substituted in a
+        # single pass so they cannot inject markup or a later sentinel
+        values = {
+            '__MESSAGE_ID__': f'uuid:{uuid.uuid4()}',
+            '__OPERATION_ID__': escape(str(envelope.operation_id)),
+            '__RELATES_TO__': escape(str(envelope.id)),
+            '__TO__': escape(str(envelope.reply_to)),
+        }
+        return PATTERN_SENTINEL.sub(lambda match: values[match.group(0)],
+                                    self.ENUMERATE_RESPONSE_TEMPLATE)
 
     def do_heartbeat(self, envelope: wsman.HeartbeatEnvelope) -> str:
-        response = wsman.AckEnvelope(envelope.id, envelope.operation_id)
-        return response.dump()
+        return wsman.dump_ack(envelope.id, envelope.operation_id)
 
     def do_events(self, envelope: wsman.EventsEnvelope) -> str:
-        for e in envelope.events:
-            event_logger.info(e.encode('utf8'))
-            # print(e.encode('utf8'))
-        response = wsman.AckEnvelope(envelope.id, envelope.operation_id)
-        return response.dump()
+        # WEF batches many events per POST; join them into one record so the
+        # listener issues a single write instead of one per event
+        events = '\n'.join(envelope.events)
+        if events:
+            event_logger.info(events)
+        return wsman.dump_ack(envelope.id, envelope.operation_id)
 
 
 if __name__ == '__main__':
@@ -211,6 +386,10 @@ if __name__ == '__main__':
                         help='The certificate file to use for https')
     parser.add_argument('--key', type=argparse.FileType('r'),
                         help='The private key file to use for https')
+    parser.add_argument('--tls-legacy', action='store_true',
+                        help='Allow TLS versions older than 1.3 for legacy clients')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='The number of worker processes sharing the listen socket, default is 1')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Be verbose')
     args = parser.parse_args()
@@ -219,7 +398,7 @@ if __name__ == '__main__':
     logger.setLevel(logging.DEBUG)
 
     cmd_handler = logging.StreamHandler()
-    cmd_handler.setFormatter(logging.Formatter('[%(asctime)s][%(threadName)s][%(levelname)s] %(message)s'))
+    cmd_handler.setFormatter(logging.Formatter('[%(asctime)s][%(peer)s][%(levelname)s] %(message)s'))
     logger.addHandler(cmd_handler)
 
     if args.verbose:
@@ -230,12 +409,21 @@ if __name__ == '__main__':
     logger.debug('Starting owinec...')
     logger.debug(f'Command line arguments: {args}')
 
+    if not args.tls_legacy:
+        # Windows Server 2016+ speaks TLS 1.3; pinning it keeps OpenSSL out
+        # of the legacy-compatibility handshake paths (single round trip,
+        # AEAD ciphers only)
+        ctx.minimum_version = ssl.TLSVersion.TLSv1_3
+
     if args.protocol in ('http', 'https'):
         logger.debug(f'Using protocol {args.protocol}')
         bind_address = str(args.listen_address)
         bind_port = args.port or WSMAN_PORT_HTTP if args.protocol == 'http' else WSMAN_PORT_HTTPS
 
-        httpd = ThreadingHTTPServer((bind_address, bind_port), WSManHandler)
+        # handler threads touch little stack; keep their mappings small so
+        # hundreds of idle subscriber connections stay cheap in RSS
+        threading.stack_size(512 * 1024)
+        httpd = WSManServer((bind_address, bind_port), WSManHandler)
 
         if args.protocol == 'https':
             if not args.cert or not args.key:
@@ -248,6 +436,14 @@ if __name__ == '__main__':
 
         logger.info(f'Listening on {args.protocol}://{bind_address}:{bind_port}/')
 
+        for _ in range(args.workers - 1):
+            if os.fork() == 0:
+                # a forked child only inherits the calling thread; restart the
+                # event log listener so events keep draining to disk
+                event_log_listener.start()
+                atexit.register(event_log_listener.stop)
+                break
+
         httpd.serve_forever()
     else:
         raise NotImplementedError()
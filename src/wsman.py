@@ -20,9 +20,15 @@
 from __future__ import annotations
 from typing import List, Tuple, Dict
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 import re
 import uuid
 
+try:
+    from lxml import etree as _lxml_etree
+except ImportError:
+    _lxml_etree = None
+
 namespace = {
     's': 'http://www.w3.org/2003/05/soap-envelope',
     'a': 'http://schemas.xmlsoap.org/ws/2004/08/addressing',
@@ -128,15 +134,19 @@ class Envelope:
         errors = []
         for error in tree.iterfind('./s:Body/*/f:WSManFault',
                                   {**namespace, 'f': 'http://schemas.microsoft.com/wbem/wsman/1/wsmanfault'}):
-            code = int(error.get('Code'))
-            machine = error.get('Machine')
-            text = ''
-            for t in error.itertext():
-                text += t + ' '
-            text = re.sub(r'\s+', ' ', text.strip())
-            errors.append({'code': code, 'machine': machine, 'text': text})
+            errors.append(Envelope._load_fault(error))
         return errors
 
+    @staticmethod
+    def _load_fault(error: ET.Element) -> Dict[str, str or int]:
+        code = int(error.get('Code'))
+        machine = error.get('Machine')
+        text = ''
+        for t in error.itertext():
+            text += t + ' '
+        text = re.sub(r'\s+', ' ', text.strip())
+        return {'code': code, 'machine': machine, 'text': text}
+
     @staticmethod
     def load(tree: ET.Element) -> Envelope:
         envelope = tree
@@ -570,6 +580,32 @@ class AckEnvelope(Envelope):
         return envelope
 
 
+def _build_ack_template() -> str:
+    envelope = AckEnvelope('__RELATES_TO__', '__OPERATION_ID__', '__MESSAGE_ID__')
+    template = envelope.dump().replace('%', '%%')
+    # sentinel order matches the header element order in AckEnvelope.xml()
+    return template \
+        .replace('__MESSAGE_ID__', '%s') \
+        .replace('__OPERATION_ID__', '%s') \
+        .replace('__RELATES_TO__', '%s')
+
+
+ACK_TEMPLATE = _build_ack_template()
+
+
+def dump_ack(relates_to: str, operation_id: str = None, message_id: str = None) -> str:
+    """Serialize an ack envelope from a pre-built template.
+
+    Acks are sent for every heartbeat and events POST; the structure is
+    fixed, so a single %-substitution replaces the tree build and
+    serialization that AckEnvelope(...).dump() would do. The ids come from
+    client-controlled header text, so they are XML-escaped exactly as the
+    tree serialization would have done."""
+    return ACK_TEMPLATE % (escape(str(message_id)) if message_id else f'uuid:{uuid.uuid4()}',
+                           escape(str(operation_id)) if operation_id else f'uuid:{uuid.uuid4()}',
+                           escape(str(relates_to)))
+
+
 class EventsEnvelope(Envelope):
     def __init__(self, identifier: str, operation_id: str, locale: str, data_locale: str, session_id: str,
                  operation_timeout: float = 60.0, machine_id: str = None, message_id: str = None):
@@ -587,7 +623,7 @@ class EventsEnvelope(Envelope):
         self.events = []
 
     @staticmethod
-    def load(tree: ET.Element) -> Envelope:
+    def _load_header(tree: ET.Element) -> EventsEnvelope:
         envelope = tree
 
         to = envelope.find('./s:Header/a:To', namespace)
@@ -619,15 +655,6 @@ class EventsEnvelope(Envelope):
         identifier = identifier.text.strip() if identifier is not None else None
         ack_requested = envelope.find('./s:Header/w:AckRequested', namespace) is not None
 
-        events = envelope.find('./s:Body/w:Events', namespace)
-        event_list = []
-        for event in events.iterfind('./w:Event', namespace):
-            event_action = Action(event.get('Action'))
-            if event_action == ACTION_EVENT:
-                event_list.append(event.text)
-            else:
-                raise NotImplementedError(f'Unknown event action: {event_action}')
-
         if action != ACTION_EVENTS:
             raise AssertionError()
 
@@ -646,9 +673,80 @@ class EventsEnvelope(Envelope):
         envelope.max_envelope_size = max_envelope_size
         envelope.sequence_id = sequence_id
         envelope.ack_requested = ack_requested
+        return envelope
+
+    @staticmethod
+    def load(tree: ET.Element) -> Envelope:
+        envelope = tree
+
+        events = envelope.find('./s:Body/w:Events', namespace)
+        event_list = []
+        for event in events.iterfind('./w:Event', namespace):
+            event_action = Action(event.get('Action'))
+            if event_action == ACTION_EVENT:
+                event_list.append(event.text)
+            else:
+                raise NotImplementedError(f'Unknown event action: {event_action}')
+
+        envelope = EventsEnvelope._load_header(tree)
         envelope.events = event_list
         envelope.errors = Envelope.get_errors(tree)
         return envelope
 
+    @staticmethod
+    def stream(source) -> EventsEnvelope or None:
+        """Parse an events envelope incrementally from a file-like object.
+
+        The header is materialized as usual, but the events in the body are
+        exposed as a generator that consumes the parser one <w:Event> at a
+        time and clears each element after it is yielded, so memory stays
+        O(one event) instead of O(envelope size). Faults in the body are
+        appended to envelope.errors while the generator is consumed.
+        Returns None if the envelope turns out not to be an events envelope,
+        so the caller can fall back to Envelope.load()."""
+        etree = _lxml_etree or ET
+        iterator = etree.iterparse(source, events=('end',))
+        header_tag = '{' + namespace['s'] + '}Header'
+        header = None
+        for _, elem in iterator:
+            if elem.tag == header_tag:
+                header = elem
+                break
+        if header is None:
+            raise AssertionError()
+
+        root = etree.Element('{' + namespace['s'] + '}Envelope')
+        root.append(header)
+        action = root.find('./s:Header/a:Action', namespace)
+        action = action.text.strip() if action is not None else None
+        if action != ACTION_EVENTS:
+            return None
+
+        envelope = EventsEnvelope._load_header(root)
+        envelope.events = EventsEnvelope._iter_events(iterator, envelope.errors)
+        return envelope
+
+    @staticmethod
+    def _iter_events(iterator, errors: List[Dict[str, str or int]]):
+        event_tag = '{' + namespace['w'] + '}Event'
+        fault_tag = '{http://schemas.microsoft.com/wbem/wsman/1/wsmanfault}WSManFault'
+        for _, elem in iterator:
+            if elem.tag == fault_tag:
+                errors.append(Envelope._load_fault(elem))
+                continue
+            if elem.tag != event_tag:
+                continue
+            event_action = Action(elem.get('Action'))
+            if event_action != ACTION_EVENT:
+                raise NotImplementedError(f'Unknown event action: {event_action}')
+            text = elem.text
+            elem.clear()
+            if _lxml_etree is not None and isinstance(elem, _lxml_etree._Element):
+                # lxml keeps cleared elements attached to the tree; drop
+                # already-processed siblings to actually release the memory
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            yield text
+
     def xml(self) -> ET.Element:
         raise NotImplementedError()  # TODO EventsEnvelope.xml() is needed for client